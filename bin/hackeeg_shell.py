@@ -261,9 +261,9 @@ class HackEEGShell(cmd.Cmd):
         print("Unrecognized command.")
 
     def setup(self, samplesPerSecond=500):
-        if samplesPerSecond not in hackeeg.SPEEDS.keys():
-            raise hackeeg.HackEEGException("{} is not a valid speed; valid speeds are {}".format(
-                samplesPerSecond, sorted(hackeeg.SPEEDS.keys())))
+        if samplesPerSecond not in hackeeg.driver.SPEEDS:
+            raise hackeeg.driver.HackEEGException("{} is not a valid speed; valid speeds are {}".format(
+                samplesPerSecond, sorted(hackeeg.driver.SPEEDS)))
         self.hackeeg.jsonlines_mode()
         # self.hackeeg.sdatac()
         time.sleep(1)
@@ -7,18 +7,30 @@
 # (--messagepack option)
 
 import argparse
+import io
+import queue
+import threading
 import uuid
 import time
 import sys
 import select
 
+import numpy as np
 from pylsl import StreamInfo, StreamOutlet
 
 import hackeeg
 from hackeeg import ads1299
-from hackeeg.driver import SPEEDS, GAINS, Status
+from hackeeg.driver import SPEEDS, GAINS, format_hex
 
 DEFAULT_NUMBER_OF_SAMPLES_TO_CAPTURE = 50000
+VALID_SPEEDS = sorted(SPEEDS)
+VALID_GAINS = sorted(GAINS)
+NUMBER_OF_CHANNELS = 8
+OUTPUT_FLUSH_INTERVAL = 1024  # samples of formatted output to buffer between writes to stdout
+READ_BATCH_SIZE = 32  # responses read from the board per loop iteration
+LSL_CHUNK_SIZE = 64  # samples per push_chunk call to the LSL outlet
+# "1:{} 2:{} ... 8:{} " built once, so a sample's channels are formatted in one str.format call
+CHANNEL_DATA_FORMAT = "".join(f"{channel_number + 1}:{{}} " for channel_number in range(NUMBER_OF_CHANNELS)) + "\n"
 
 
 class HackEegTestApplicationException(Exception):
@@ -78,6 +90,19 @@ class HackEegTestApplication:
         self.stream_id = str(uuid.uuid4())
         self.read_samples_continuously = True
         self.continuous_mode = False
+        self.timestamps = None
+        self.sample_numbers = None
+        self.channel_data = None
+        self.ads_gpio = None
+        self.loff_statp = None
+        self.loff_statn = None
+        self.stored_samples = 0
+        self.lsl_pushed_samples = 0
+        self.output_buffer = io.StringIO()
+        self.buffered_output_lines = 0
+        self.output_queue = queue.Queue()
+        self.output_thread = None
+        self.process_samples = None
 
         print(f"platform: {sys.platform}")
         if sys.platform == "linux" or sys.platform == "linux2" or sys.platform == "darwin":
@@ -87,16 +112,54 @@ class HackEegTestApplication:
         self.non_blocking_console.init()
         # self.debug = True
 
-    def find_dropped_samples(self, samples, number_of_samples):
-        sample_numbers = {self.get_sample_number(sample): 1 for sample in samples}
-        correct_sequence = {index: 1 for index in range(0, number_of_samples)}
-        missing_samples = [sample_number for sample_number in correct_sequence.keys()
-                           if sample_number not in sample_numbers]
-        return len(missing_samples)
-
-    def get_sample_number(self, sample):
-        sample_number = sample.get('sample_number', -1)
-        return sample_number
+    def find_dropped_samples(self, sample_numbers, number_of_samples):
+        correct_sequence = np.arange(number_of_samples, dtype=np.int64)
+        return int(np.setdiff1d(correct_sequence, sample_numbers).size)
+
+    def allocate_sample_buffers(self, size):
+        """Preallocate one array per sample field, so storing a sample is a few indexed writes
+        instead of keeping the whole decoded response dict alive."""
+        self.timestamps = np.empty(size, dtype=np.int64)
+        self.sample_numbers = np.empty(size, dtype=np.int64)
+        self.channel_data = np.empty((size, NUMBER_OF_CHANNELS), dtype=np.int32)
+        self.ads_gpio = np.empty(size, dtype=np.uint8)
+        self.loff_statp = np.empty(size, dtype=np.uint8)
+        self.loff_statn = np.empty(size, dtype=np.uint8)
+        self.stored_samples = 0
+
+    def grow_sample_buffers(self, needed):
+        """Double the sample buffers until `needed` samples fit; only needed in continuous mode,
+        where the capture length is unknown."""
+        size = max(2 * len(self.timestamps), 1024)
+        while size < needed:
+            size *= 2
+        self.timestamps = np.resize(self.timestamps, size)
+        self.sample_numbers = np.resize(self.sample_numbers, size)
+        self.channel_data = np.resize(self.channel_data, (size, NUMBER_OF_CHANNELS))
+        self.ads_gpio = np.resize(self.ads_gpio, size)
+        self.loff_statp = np.resize(self.loff_statp, size)
+        self.loff_statn = np.resize(self.loff_statn, size)
+
+    def store_samples(self, samples):
+        """Copy a block of decoded samples (see hackeeg.driver.decode_sample_block) into the sample
+        buffers with one slice assignment per field."""
+        start = self.stored_samples
+        end = start + len(samples['sample_number'])
+        if end > len(self.timestamps):
+            self.grow_sample_buffers(end)
+        self.timestamps[start:end] = samples['timestamp']
+        self.sample_numbers[start:end] = samples['sample_number']
+        self.channel_data[start:end] = samples['channel_data']
+        self.ads_gpio[start:end] = samples['ads_gpio']
+        self.loff_statp[start:end] = samples['loff_statp']
+        self.loff_statn[start:end] = samples['loff_statn']
+        self.stored_samples = end
+
+    def push_lsl_chunk(self):
+        """Send every stored sample not yet sent to the LSL outlet in one push_chunk call."""
+        if self.stored_samples > self.lsl_pushed_samples:
+            self.lsl_outlet.push_chunk(self.channel_data[self.lsl_pushed_samples:self.stored_samples])
+            self.lsl_pushed_samples = self.stored_samples
 
     def read_keyboard_input(self):
         char = self.non_blocking_console.get_data()
@@ -104,12 +167,12 @@ class HackEegTestApplication:
             self.read_samples_continuously = False
 
     def setup(self, samples_per_second=500, gain=1, messagepack=False):
-        if samples_per_second not in SPEEDS.keys():
+        if samples_per_second not in SPEEDS:
             raise HackEegTestApplicationException("{} is not a valid speed; valid speeds are {}".format(
-                samples_per_second, sorted(SPEEDS.keys())))
-        if gain not in GAINS.keys():
+                samples_per_second, VALID_SPEEDS))
+        if gain not in GAINS:
             raise HackEegTestApplicationException("{} is not a valid gain; valid gains are {}".format(
-                gain, sorted(GAINS.keys())))
+                gain, VALID_GAINS))
 
         self.hackeeg.stop_and_sdatac_messagepack()
         self.hackeeg.sdatac()
@@ -145,6 +208,9 @@ class HackEegTestApplication:
             self.hackeeg.jsonlines_mode()
         self.hackeeg.start()
         self.hackeeg.rdatac()
+        if messagepack:
+            # read the port on a background thread, so waiting for bytes overlaps with decoding samples
+            self.hackeeg.start_reader_thread()
         return
 
     def channel_config_input(self, gain_setting):
@@ -154,14 +220,7 @@ class HackEegTestApplication:
 
         # self.hackeeg.wreg(ads1299.CHnSET + 1, ads1299.INT_TEST_DC | gain_setting)
         # self.hackeeg.wreg(ads1299.CHnSET + 6, ads1299.INT_TEST_DC | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 1, ads1299.ELECTRODE_INPUT | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 2, ads1299.ELECTRODE_INPUT | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 3, ads1299.ELECTRODE_INPUT | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 4, ads1299.ELECTRODE_INPUT | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 5, ads1299.ELECTRODE_INPUT | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 6, ads1299.ELECTRODE_INPUT | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 7, ads1299.ELECTRODE_INPUT | gain_setting)
-        self.hackeeg.wreg(ads1299.CHnSET + 8, ads1299.ELECTRODE_INPUT | gain_setting)
+        self.hackeeg.wreg_burst(ads1299.CH1SET, [ads1299.ELECTRODE_INPUT | gain_setting] * self.channels)
 
     def channel_config_test(self):
         # test_signal_mode = ads1299.INT_TEST_DC | ads1299.CONFIG2_const
@@ -194,10 +253,10 @@ class HackEegTestApplication:
         parser.add_argument("--continuous", "-C", help="read data continuously (until <return> key is pressed)",
                             action="store_true")
         parser.add_argument("--sps", "-s",
-                            help=f"ADS1299 samples per second setting- must be one of {sorted(list(SPEEDS.keys()))}, default is {self.samples_per_second}",
+                            help=f"ADS1299 samples per second setting- must be one of {VALID_SPEEDS}, default is {self.samples_per_second}",
                             default=self.samples_per_second, type=int)
         parser.add_argument("--gain", "-g",
-                            help=f"ADS1299 gain setting for all channels– must be one of {sorted(list(GAINS.keys()))}, default is {self.gain}",
+                            help=f"ADS1299 gain setting for all channels– must be one of {VALID_GAINS}, default is {self.gain}",
                             default=self.gain, type=int)
         parser.add_argument("--lsl", "-L",
                             help=f"Send samples to an LSL stream instead of terminal",
@@ -244,66 +303,136 @@ class HackEegTestApplication:
         self.messagepack = args.messagepack
         self.hackeeg.connect()
         self.setup(samples_per_second=self.samples_per_second, gain=self.gain, messagepack=self.messagepack)
-
-    def process_sample(self, result, samples):
-        data = None
-        channel_data = None
-        if result:
-            status_code = result.get(self.hackeeg.MpStatusCodeKey)
-            data = result.get(self.hackeeg.MpDataKey)
-            samples.append(result)
-            if status_code == Status.Ok and data:
-                if not self.quiet:
-                    timestamp = result.get('timestamp')
-                    sample_number = result.get('sample_number')
-                    ads_gpio = result.get('ads_gpio')
-                    loff_statp = result.get('loff_statp')
-                    loff_statn = result.get('loff_statn')
-                    channel_data = result.get('channel_data')
-                    data_hex = result.get('data_hex')
-                    print(
-                        f"timestamp:{timestamp} sample_number: {sample_number}| gpio:{ads_gpio} loff_statp:{loff_statp} loff_statn:{loff_statn}   ",
-                        end='')
-                    if self.hex:
-                        print(data_hex)
-                    else:
-                        for channel_number, sample in enumerate(channel_data):
-                            print(f"{channel_number + 1}:{sample} ", end='')
-                        print()
-                if self.lsl and channel_data:
-                    self.lsl_outlet.push_sample(channel_data)
-            else:
-                if not self.quiet:
-                    print(data)
+        self.process_samples = self.make_sample_processor()
+
+    def write_output(self, text, lines=1):
+        """Buffer formatted output; writing to stdout once per sample costs a syscall each time."""
+        self.output_buffer.write(text)
+        self.buffered_output_lines += lines
+        if self.buffered_output_lines >= OUTPUT_FLUSH_INTERVAL:
+            self.flush_output()
+
+    def flush_output(self):
+        self.output_queue.put(self.output_buffer.getvalue())
+        self.output_buffer.seek(0)
+        self.output_buffer.truncate()
+        self.buffered_output_lines = 0
+
+    def write_queued_output(self):
+        """Runs on the output thread, so a slow terminal never stalls reading from the serial port."""
+        while True:
+            text = self.output_queue.get()
+            if text is None:
+                break
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def start_output_thread(self):
+        self.output_thread = threading.Thread(target=self.write_queued_output, daemon=True)
+        self.output_thread.start()
+
+    def stop_output_thread(self):
+        self.flush_output()
+        self.output_queue.put(None)
+        self.output_thread.join()
+
+    def make_sample_processor(self):
+        """Build process_samples specialized for the quiet, hex and lsl settings, which are fixed
+        once parse_args has run, so the per-block path carries no flag tests for them. process_samples
+        takes the (samples, responses) pair returned by HackEEGBoard.read_rdatac_block."""
+        data_key = self.hackeeg.MpDataKey
+        store_samples = self.store_samples
+        write_output = self.write_output
+
+        if self.lsl:
+            push_lsl_chunk = self.push_lsl_chunk
+
+            def store(samples):
+                store_samples(samples)
+                if self.stored_samples - self.lsl_pushed_samples >= LSL_CHUNK_SIZE:
+                    push_lsl_chunk()
+        else:
+            store = store_samples
+
+        def format_response(result):
+            if result and type(result) is dict:
+                return f"{result.get(data_key)}\n"
+            return f"no data to decode\nresult: {result}\n"
+
+        if self.quiet:
+            def process_samples(block):
+                samples, responses = block
+                store(samples)
+                for _, result in responses:
+                    if not result or type(result) is not dict:
+                        write_output(f"no data to decode\nresult: {result}\n")
+            return process_samples
+
+        if self.hex:
+            def format_data(samples):
+                return [f"{format_hex(frame)}\n" for frame in samples['data_raw'].tolist()]
         else:
-            print("no data to decode")
-            print(f"result: {result}")
+            def format_data(samples):
+                return [CHANNEL_DATA_FORMAT.format(*channels) for channels in samples['channel_data'].tolist()]
+
+        def process_samples(block):
+            samples, responses = block
+            lines = []
+            if len(samples['sample_number']):
+                store(samples)
+                lines = [
+                    f"timestamp:{timestamp} sample_number: {sample_number}| gpio:{gpio} loff_statp:{loff_statp} loff_statn:{loff_statn}   "
+                    + data
+                    for timestamp, sample_number, gpio, loff_statp, loff_statn, data in zip(
+                        samples['timestamp'].tolist(), samples['sample_number'].tolist(),
+                        samples['ads_gpio'].tolist(), samples['loff_statp'].tolist(),
+                        samples['loff_statn'].tolist(), format_data(samples))]
+            # put each response back where it arrived among the samples; last first, so earlier positions stay valid
+            for position, result in reversed(responses):
+                lines.insert(position, format_response(result))
+            if lines:
+                write_output("".join(lines), lines=len(lines))
+        return process_samples
 
     def main(self):
         self.parse_args()
 
-        samples = []
+        self.allocate_sample_buffers(self.max_samples)
+        self.start_output_thread()
         sample_counter = 0
 
-        end_time = time.perf_counter()
+        # bind everything the read loop touches to locals; attribute lookups add up at 16k samples per second
+        read_rdatac_block = self.hackeeg.read_rdatac_block
+        process_samples = self.process_samples
+        read_keyboard_input = self.read_keyboard_input
+        max_samples = self.max_samples
+        continuous_mode = self.continuous_mode
+
         start_time = time.perf_counter()
-        while ((sample_counter < self.max_samples and not self.continuous_mode) or \
-               (self.read_samples_continuously and self.continuous_mode)):
-            result = self.hackeeg.read_rdatac_response()
-            end_time = time.perf_counter()
-            sample_counter += 1
-            if self.continuous_mode:
-                self.read_keyboard_input()
-            self.process_sample(result, samples)
+        while ((sample_counter < max_samples and not continuous_mode) or \
+               (self.read_samples_continuously and continuous_mode)):
+            if continuous_mode:
+                batch_size = READ_BATCH_SIZE
+            else:
+                batch_size = min(READ_BATCH_SIZE, max_samples - sample_counter)
+            block = read_rdatac_block(batch_size)
+            sample_counter += batch_size
+            if continuous_mode:
+                read_keyboard_input()
+            process_samples(block)
+        end_time = time.perf_counter()
 
         duration = end_time - start_time
+        if self.lsl:
+            self.push_lsl_chunk()
+        self.stop_output_thread()
         self.hackeeg.stop_and_sdatac_messagepack()
         self.hackeeg.blink_board_led()
 
         print(f"duration in seconds: {duration}")
         samples_per_second = sample_counter / duration
         print(f"samples per second: {samples_per_second}")
-        dropped_samples = self.find_dropped_samples(samples, sample_counter)
+        dropped_samples = self.find_dropped_samples(self.sample_numbers[:self.stored_samples], sample_counter)
         print(f"dropped samples: {dropped_samples}")
 
 
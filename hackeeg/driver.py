@@ -1,16 +1,23 @@
-import base64
 import binascii
 import io
 import json
-import sys
+import queue
+import struct
 from json import JSONDecodeError
 
 import msgpack
+import numpy as np
 import serial
+import serial.threaded
 import time
 
 from . import ads1299
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; the standard library json module is the fallback
+    orjson = None
+
 # TODO
 # - MessagePack
 # - MessagePack / Json Lines testing convenience functions
@@ -18,6 +25,19 @@ from . import ads1299
 NUMBER_OF_SAMPLES = 10000
 DEFAULT_BAUDRATE = 115200
 SAMPLE_LENGTH_IN_BYTES = 38  # 216 bits encoded with base64 + '\r\n\'
+SAMPLE_PAYLOAD_LENGTH = 35  # timestamp (4) + sample number (4) + ADS1299 status (3) + 8 channels (3 each)
+CHANNEL_DATA_OFFSETS = tuple(range(11, 11 + 8 * 3, 3))  # byte offset of each 24-bit channel sample in a data frame
+SAMPLE_HEADER = struct.Struct('<II')  # little-endian timestamp and sample number at the start of a data frame
+SERIAL_RX_BUFFER_SIZE = 262144  # OS receive buffer, where the platform lets us size it (Windows)
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+else:
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 SPEEDS = {250: ads1299.HIGH_RES_250_SPS,
           500: ads1299.HIGH_RES_500_SPS,
@@ -36,6 +56,33 @@ GAINS = {1: ads1299.GAIN_1X,
          24: ads1299.GAIN_24X}
 
 
+def format_hex(data):
+    """format sample bytes as colon-separated hex, e.g. 01:a2:ff"""
+    return ":".join("{:02x}".format(c) for c in data)
+
+
+def decode_sample_block(payloads):
+    """decode a list of raw SAMPLE_PAYLOAD_LENGTH-byte sample payloads in one vectorized pass– the block
+    counterpart of HackEEGBoard._decode_data. Returns a dict of NumPy arrays with the same keys _decode_data adds
+    to a response, one entry per sample; 'data_raw' holds the payload bytes, one row per sample."""
+    frames = np.frombuffer(b"".join(payloads), dtype=np.uint8).reshape(len(payloads), SAMPLE_PAYLOAD_LENGTH)
+    header = frames[:, 0:8].copy().view('<u4')
+    status_bytes = frames[:, 8:11].astype(np.uint32)
+    ads_status = (status_bytes[:, 0] << 16) | (status_bytes[:, 1] << 8) | status_bytes[:, 2]
+    # place each big-endian 24-bit sample in the top of a 32-bit word, then shift back down to sign-extend it
+    channel_bytes = frames[:, 11:35].reshape(-1, 8, 3).astype(np.uint32)
+    channel_words = (channel_bytes[:, :, 0] << 24) | (channel_bytes[:, :, 1] << 16) | (channel_bytes[:, :, 2] << 8)
+    return {'timestamp': header[:, 0],
+            'sample_number': header[:, 1],
+            'ads_status': ads_status,
+            'ads_gpio': ads_status & 0x0f,
+            'loff_statn': (ads_status >> 4) & 0xff,
+            'loff_statp': (ads_status >> 12) & 0xff,
+            'extra': (ads_status >> 20) & 0xff,
+            'channel_data': channel_words.view(np.int32) >> 8,
+            'data_raw': frames}
+
+
 class Status:
     Ok = 200
     BadRequest = 400
@@ -46,6 +93,39 @@ class HackEEGException(Exception):
     pass
 
 
+class SerialReader(io.RawIOBase):
+    """read side of the serial port for io.BufferedReader– each read takes whatever the OS has already buffered
+    (at least one byte), instead of waiting for a full buffer's worth of bytes or the port timeout"""
+
+    def __init__(self, serial_port):
+        super().__init__()
+        self.serial_port = serial_port
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), max(1, self.serial_port.in_waiting))
+        data = self.serial_port.read(size)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class SerialChunkQueue(serial.threaded.Protocol):
+    """serial.threaded.ReaderThread protocol that queues each chunk the reader thread receives"""
+
+    def __init__(self):
+        self.chunks = queue.Queue()
+
+    def data_received(self, data):
+        self.chunks.put(data)
+
+    def connection_lost(self, exc):
+        # the reader thread ends here; queue the port error so the reading thread raises it
+        if isinstance(exc, Exception):
+            self.chunks.put(exc)
+
+
 class HackEEGBoard:
     TextMode = 0
     JsonLinesMode = 1
@@ -74,15 +154,22 @@ class HackEEGBoard:
         self.debug = debug
         self.baudrate = baudrate
         self.rdatac_mode = False
+        self.reader_thread = None
+        self.reader_chunks = None
+        self.encoded_commands = {}  # (command name, parameters is None) -> encoded JSON Lines bytes of a parameterless command
         self.serial_port_path = serial_port_path
         if serial_port_path:
             self.raw_serial_port = serial.serial_for_url(serial_port_path, baudrate=self.baudrate, timeout=0.1)
             self.raw_serial_port.reset_input_buffer()
+            if hasattr(self.raw_serial_port, "set_buffer_size"):
+                self.raw_serial_port.set_buffer_size(rx_size=SERIAL_RX_BUFFER_SIZE)
             # self.serial_port= self.raw_serial_port
-            self.serial_port = io.TextIOWrapper(io.BufferedRWPair(self.raw_serial_port, self.raw_serial_port))
+            # binary, so lines go to json_loads as bytes without a decode pass
+            self.serial_port = io.BufferedRWPair(SerialReader(self.raw_serial_port), self.raw_serial_port)
             # self.binaryBufferedSerialPort = io.BufferedReader(io.BufferedRWPair(self.raw_serial_port, self.raw_serial_port))
             # self.message_pack_unpacker = msgpack.Unpacker(self.binaryBufferedSerialPort, raw=False, use_list=False)
-            self.message_pack_unpacker = msgpack.Unpacker(self.raw_serial_port, raw=False, use_list=False)
+            # fed from the port in _serial_read_messagepack_message, so reads are sized by what has arrived
+            self.message_pack_unpacker = msgpack.Unpacker(raw=False, use_list=False)
 
     def connect(self):
         self.mode = self._sense_protocol_mode()
@@ -96,10 +183,9 @@ class HackEEGBoard:
                     break
                 except JSONDecodeError:
                     if attempts == 0:
-                        print("Connecting...", end='')
+                        print("Connecting...", end='', flush=True)
                     elif attempts > 0:
-                        print('.', end='')
-                    sys.stdout.flush()
+                        print('.', end='', flush=True)
                     attempts += 1
                     time.sleep(self.ConnectionSleepTime)
             if attempts > 0:
@@ -107,12 +193,27 @@ class HackEEGBoard:
             if not connected:
                 raise HackEEGException("Can't connect to Arduino")
         self.sdatac()
-        line = self.serial_port.readline()
-        while line:
-            line = self.serial_port.readline()
+        self._discard_input()
+
+    def _discard_input(self):
+        """drop everything received so far– reset the OS buffer, read out whatever is still buffered or
+        arriving, and start over with a fresh MessagePack unpacker"""
+        self.raw_serial_port.reset_input_buffer()
+        # with a zero timeout, read1 empties the read buffer and the port without waiting for more bytes
+        timeout = self.raw_serial_port.timeout
+        self.raw_serial_port.timeout = 0
+        try:
+            while self.serial_port.read1(SERIAL_RX_BUFFER_SIZE):
+                pass
+        finally:
+            self.raw_serial_port.timeout = timeout
+        self.message_pack_unpacker = msgpack.Unpacker(raw=False, use_list=False)
 
     def _serial_write(self, command):
-        self.serial_port.write(command)
+        self._serial_write_bytes(command.encode())
+
+    def _serial_write_bytes(self, data):
+        self.serial_port.write(data)
         self.serial_port.flush()
 
     def _serial_readline(self, serial_port=None):
@@ -124,8 +225,57 @@ class HackEEGBoard:
             raise HackEEGException('Unknown serial port designator; must be either None or "raw"')
         return line
 
+    def _read_serial_chunk(self):
+        """return whatever bytes have arrived (at least one), or b'' if the port times out first– from the
+        reader thread's queue while it is running, otherwise straight from the port. A port error on the
+        reader thread is raised here."""
+        if self.reader_thread is not None:
+            try:
+                chunk = self.reader_chunks.get(timeout=self.raw_serial_port.timeout)
+            except queue.Empty:
+                if not self.reader_thread.alive:
+                    raise HackEEGException("the serial reader thread has stopped")
+                return b''
+            if type(chunk) is not bytes:
+                raise chunk
+            return chunk
+        return self.raw_serial_port.read(max(1, self.raw_serial_port.in_waiting))
+
+    def start_reader_thread(self):
+        """read the serial port on a background thread while in rdatac MessagePack mode, so waiting on
+        the port overlaps with decoding samples. Stopped by sdatac() and stop_and_sdatac_messagepack()."""
+        if self.mode != self.MessagePackMode:
+            raise HackEEGException("the reader thread needs MessagePack mode")
+        if self.reader_thread is None:
+            self.reader_thread = serial.threaded.ReaderThread(self.raw_serial_port, SerialChunkQueue)
+            self.reader_thread.start()
+            transport, protocol = self.reader_thread.connect()
+            self.reader_chunks = protocol.chunks
+
+    def stop_reader_thread(self):
+        if self.reader_thread is not None:
+            # not ReaderThread.stop(): its cancel_read() can leave a byte in pyserial's abort pipe, which makes
+            # the next read on the port return empty at once. The thread's own reads end within the port timeout.
+            self.reader_thread.alive = False
+            self.reader_thread.join(2)
+            self.reader_thread = None
+            self.reader_chunks = None
+            # drop any partial frame already fed in, so the next rdatac starts on a frame boundary
+            self.message_pack_unpacker = msgpack.Unpacker(raw=False, use_list=False)
+
     def _serial_read_messagepack_message(self):
-        message = self.message_pack_unpacker.unpack()
+        """return the next MessagePack message, or None if the port times out before a whole message arrives"""
+        unpacker = self.message_pack_unpacker
+        message = None
+        while True:
+            try:
+                message = next(unpacker)
+                break
+            except StopIteration:
+                chunk = self._read_serial_chunk()
+                if not chunk:
+                    break
+                unpacker.feed(chunk)
         if self.debug:
             print(f"message: {message}")
         return message
@@ -134,47 +284,66 @@ class HackEEGBoard:
         """decode ADS1299 sample status bits - datasheet, p36
         The format is:
         1100 + LOFF_STATP[0:7] + LOFF_STATN[0:7] + bits[4:7] of the GPIOregister"""
-        error = False
         if response:
             data = response.get(self.DataKey)
             if data is None:
                 data = response.get(self.MpDataKey)
                 if type(data) is str:
                     try:
-                        data = base64.b64decode(data)
+                        data = binascii.a2b_base64(data)
                     except binascii.Error:
                         print(f"incorrect padding: {data}")
 
-            if data and (type(data) is list or type(data) is bytes):
-                data_hex = ":".join("{:02x}".format(c) for c in data)
-                if error:
-                    print(data_hex)
-                timestamp = int.from_bytes(data[0:4], byteorder='little')
-                sample_number = int.from_bytes(data[4:8], byteorder='little')
-                ads_status = int.from_bytes(data[8:11], byteorder='big')
-                ads_gpio = ads_status & 0x0f
-                loff_statn = (ads_status >> 4) & 0xff
-                loff_statp = (ads_status >> 12) & 0xff
-                extra = (ads_status >> 20) & 0xff
-
-                channel_data = []
-                for channel in range(0, 8):
-                    channel_offset = 11 + (channel * 3)
-                    sample = int.from_bytes(data[channel_offset:channel_offset + 3], byteorder='big', signed=True)
-                    channel_data.append(sample)
-
-                response['timestamp'] = timestamp
-                response['sample_number'] = sample_number
-                response['ads_status'] = ads_status
-                response['ads_gpio'] = ads_gpio
-                response['loff_statn'] = loff_statn
-                response['loff_statp'] = loff_statp
-                response['extra'] = extra
-                response['channel_data'] = channel_data
-                response['data_hex'] = data_hex
-                response['data_raw'] = data
+            if data and (type(data) is list or type(data) is bytes) and len(data) >= SAMPLE_PAYLOAD_LENGTH:
+                self._decode_sample(response, bytes(data))
+        return response
+
+    def _decode_messagepack_data(self, response):
+        """_decode_data for rdatac messages in MessagePack mode– the sample is always bytes under MpDataKey"""
+        if response:
+            data = response.get(self.MpDataKey)
+            if type(data) is bytes and len(data) >= SAMPLE_PAYLOAD_LENGTH:
+                self._decode_sample(response, data)
         return response
 
+    def _decode_jsonlines_data(self, response):
+        """_decode_data for rdatac messages in JSON Lines mode– the sample is always base64 under MpDataKey"""
+        if response:
+            data = response.get(self.MpDataKey)
+            if data and type(data) is str:
+                try:
+                    decoded_data = binascii.a2b_base64(data)
+                except binascii.Error:
+                    print(f"incorrect padding: {data}")
+                else:
+                    if len(decoded_data) >= SAMPLE_PAYLOAD_LENGTH:
+                        self._decode_sample(response, decoded_data)
+        return response
+
+    def _decode_sample(self, response, data):
+        timestamp, sample_number = SAMPLE_HEADER.unpack_from(data)
+        ads_status = (data[8] << 16) | (data[9] << 8) | data[10]
+        ads_gpio = ads_status & 0x0f
+        loff_statn = (ads_status >> 4) & 0xff
+        loff_statp = (ads_status >> 12) & 0xff
+        extra = (ads_status >> 20) & 0xff
+
+        from_bytes = int.from_bytes  # looked up once rather than once per channel
+        channel_data = [from_bytes(data[offset:offset + 3], byteorder='big', signed=True)
+                        for offset in CHANNEL_DATA_OFFSETS]
+
+        response['timestamp'] = timestamp
+        response['sample_number'] = sample_number
+        response['ads_status'] = ads_status
+        response['ads_gpio'] = ads_gpio
+        response['loff_statn'] = loff_statn
+        response['loff_statp'] = loff_statp
+        response['extra'] = extra
+        response['channel_data'] = channel_data
+        if self.debug:
+            response['data_hex'] = format_hex(data)
+        response['data_raw'] = data
+
     def set_debug(self, debug):
         self.debug = debug
 
@@ -182,39 +351,80 @@ class HackEEGBoard:
         """read a response from the Arduino– must be in JSON Lines mode"""
         message = self._serial_readline(serial_port=serial_port)
         try:
-            response_obj = json.loads(message)
+            response_obj = json_loads(message)
         except UnicodeDecodeError:
             response_obj = None
         # except JSONDecodeError:
         #     response_obj = None
         if self.debug:
             print(f"read_response line: {message}")
-        if self.debug:
             print("json response:")
             print(self.format_json(response_obj))
         return self._decode_data(response_obj)
 
-    def read_rdatac_response(self):
-        """read a response from the Arduino– JSON Lines or MessagePack mode are ok"""
+    def _serial_read_jsonlines_message(self):
+        message = self._serial_readline()
+        try:
+            response_obj = json_loads(message)
+        except JSONDecodeError:
+            response_obj = {}
+            print()
+            print(f"json decode error: {message}")
+        return response_obj
+
+    def _rdatac_message_reader(self):
+        """pick the message reader for the current protocol mode– a caller reading many messages can resolve it once"""
         if self.mode == self.MessagePackMode:
-            response_obj = self._serial_read_messagepack_message()
-        else:
-            message = self._serial_readline()
-            try:
-                response_obj = json.loads(message)
-            except JSONDecodeError:
-                response_obj = {}
-                print()
-                print(f"json decode error: {message}")
+            return self._serial_read_messagepack_message
+        return self._serial_read_jsonlines_message
+
+    def _rdatac_data_decoder(self):
+        """pick the sample decoder for the current protocol mode once, rather than probing the message on every sample"""
+        if self.mode == self.MessagePackMode:
+            return self._decode_messagepack_data
+        return self._decode_jsonlines_data
+
+    def _decode_rdatac_message(self, response_obj, decode_data):
         if self.debug:
             print(f"read_response obj: {response_obj}")
         result = None
         try:
-            result = self._decode_data(response_obj)
+            result = decode_data(response_obj)
         except AttributeError:
             pass
         return result
 
+    def read_rdatac_response(self):
+        """read a response from the Arduino– JSON Lines or MessagePack mode are ok"""
+        return self._decode_rdatac_message(self._rdatac_message_reader()(), self._rdatac_data_decoder())
+
+    def read_rdatac_block(self, count):
+        """read `count` responses from the Arduino and decode the samples among them together– JSON Lines or
+        MessagePack mode are ok. Returns (samples, responses): samples is a dict of NumPy arrays as returned by
+        decode_sample_block, responses is a list of (position, message) pairs for the messages that were not
+        samples, in arrival order– position is the number of samples in the block that arrived before the message."""
+        read_message = self._rdatac_message_reader()
+        status_key = self.MpStatusCodeKey
+        data_key = self.MpDataKey
+        payloads = []
+        responses = []
+        for _ in range(count):
+            message = read_message()
+            data = None
+            # anything but a dict (e.g. from a misframed MessagePack stream) is passed on as a response
+            if type(message) is dict and message.get(status_key) == Status.Ok:
+                data = message.get(data_key)
+                if type(data) is str:
+                    try:
+                        data = binascii.a2b_base64(data)
+                    except binascii.Error:
+                        print(f"incorrect padding: {data}")
+            if type(data) is bytes and len(data) >= SAMPLE_PAYLOAD_LENGTH:
+                payloads.append(data[:SAMPLE_PAYLOAD_LENGTH])
+            else:
+                responses.append((len(payloads), message))
+        return decode_sample_block(payloads), responses
+
     def format_json(self, json_obj):
         return json.dumps(json_obj, indent=4, sort_keys=True)
 
@@ -223,12 +433,20 @@ class HackEEGBoard:
             print(f"command: {command}  parameters: {parameters}")
         # commands are only sent in JSON Lines mode
         new_command_obj = {self.CommandKey: command, self.ParametersKey: parameters}
-        new_command = json.dumps(new_command_obj)
         if self.debug:
             print("json command:")
             print(self.format_json(new_command_obj))
-        self._serial_write(new_command)
-        self._serial_write('\n')
+        if not parameters:
+            # most commands take no parameters (None from send_command callers, [] from execute_command),
+            # so their encoding never changes; encode each one only once
+            key = (command, parameters is None)
+            encoded_command = self.encoded_commands.get(key)
+            if encoded_command is None:
+                encoded_command = (json_dumps(new_command_obj) + '\n').encode()
+                self.encoded_commands[key] = encoded_command
+            self._serial_write_bytes(encoded_command)
+        else:
+            self._serial_write(json_dumps(new_command_obj) + '\n')
 
     def send_text_command(self, command):
         self._serial_write(command + '\n')
@@ -257,6 +475,13 @@ class HackEEGBoard:
         parameters = [register, value]
         return self.execute_command(command, parameters)
 
+    def wreg_burst(self, start_register, values):
+        """write consecutive registers starting at start_register– all the wreg commands are sent
+        before any response is read, so the batch costs one round trip to the Arduino instead of one per register"""
+        for offset, value in enumerate(values):
+            self.send_command("wreg", [start_register + offset, value])
+        return [self.read_response() for _ in values]
+
     def rreg(self, register):
         command = "rreg"
         parameters = [register]
@@ -331,6 +556,7 @@ class HackEEGBoard:
         return result
 
     def sdatac(self):
+        self.stop_reader_thread()
         if self.mode == self.JsonLinesMode:
             result = self.execute_command("sdatac")
         else:
@@ -342,13 +568,11 @@ class HackEEGBoard:
     def stop_and_sdatac_messagepack(self):
         """used to smoothly stop data transmission while in MessagePack mode–
         mostly avoids exceptions and other hiccups"""
+        self.stop_reader_thread()
         self.send_command("stop")
         self.send_command("sdatac")
         self.send_command("nop")
-        try:
-            line = self.serial_port.read()
-        except UnicodeDecodeError:
-            line = self.raw_serial_port.read()
+        line = self.serial_port.read()
 
     def enable_channel(self, channel, gain=None):
         if gain is None:
@@ -372,8 +596,7 @@ class HackEEGBoard:
             self.enable_channel(channel)
 
     def disable_all_channels(self):
-        for channel in range(1, 9):
-            self.disable_channel(channel)
+        self.wreg_burst(ads1299.CH1SET, [ads1299.PDn | ads1299.SHORTED] * 8)
 
     def blink_board_led(self):
         self.execute_command("boardledon")